@@ -0,0 +1,58 @@
+"""
+📄 استخراج نص PDF داخل عمليات pdf_pool
+
+وحدة صغيرة بلا آثار جانبية عند الاستيراد: عمليات المجمع تستورد هذه الوحدة فقط
+ولا تعيد تشغيل البوت (قاعدة البيانات، الكاش، النماذج...). لا تستخدم السجل أو
+قاعدة البيانات هنا.
+"""
+
+import sys
+import multiprocessing
+from typing import List
+
+import PyPDF2
+
+
+def page_count(path: str) -> int:
+    return len(PyPDF2.PdfReader(path).pages)
+
+
+def extract_pages(path: str, start: int, end: int) -> List[str]:
+    reader = PyPDF2.PdfReader(path)
+    return [(reader.pages[i].extract_text() or "") for i in range(start, end)]
+
+
+# forkserver (أو spawn إن لم يتوفر) بدل fork: fork من عملية البوت متعددة الخيوط قد ينسخ
+# أقفالاً محجوزة (كاتب قاعدة البيانات، httpx...)
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+_base_context = multiprocessing.get_context(START_METHOD)
+
+
+class WorkerProcess(_base_context.Process):
+    """
+    عملية تبدأ وهذه الوحدة هي __main__
+
+    في forkserver/spawn يعيد multiprocessing تشغيل وحدة __main__ في كل عملية جديدة،
+    ووحدة __main__ في البوت هي ملف البوت نفسه.
+    """
+
+    @staticmethod
+    def _Popen(process_obj):
+        main = sys.modules['__main__']
+        sys.modules['__main__'] = sys.modules[__name__]
+        try:
+            return _base_context.Process._Popen(process_obj)
+        finally:
+            sys.modules['__main__'] = main
+
+
+class WorkerContext(type(_base_context)):
+    Process = WorkerProcess
+
+
+def get_context() -> multiprocessing.context.BaseContext:
+    """سياق multiprocessing لمجمع PDF"""
+    if START_METHOD == 'forkserver':
+        # خادم fork يستورد PyPDF2 مرة واحدة وتبدأ العمليات منه جاهزة
+        _base_context.set_forkserver_preload([__name__])
+    return WorkerContext()
@@ -0,0 +1,26 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# البوت ينشئ bot_database.db و ocr_cache في المجلد الحالي عند الاستيراد
+_workdir = tempfile.mkdtemp(prefix="boykta-tests-")
+os.chdir(_workdir)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import telegram_bot  # noqa: E402
+
+
+@pytest.fixture
+def tb():
+    return telegram_bot
+
+
+@pytest.fixture
+def fresh_db(tmp_path, monkeypatch):
+    """قاعدة بيانات جديدة تحل محل db العامة أثناء الاختبار"""
+    database = telegram_bot.Database(use_database=True, path=str(tmp_path / "bot.db"))
+    monkeypatch.setattr(telegram_bot, "db", database)
+    yield database
+    database.writer.close()
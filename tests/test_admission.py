@@ -0,0 +1,53 @@
+import asyncio
+
+
+def flush(database):
+    """انتظار تنفيذ كل ما في طابور الكاتب"""
+    database.writer.run(lambda cursor: None, wait=True)
+
+
+def message_count(database, user_id):
+    flush(database)
+    return database.conn.execute('SELECT message_count FROM users WHERE user_id = ?', (user_id,)).fetchone()[0]
+
+
+def test_each_message_is_counted_once(fresh_db):
+    for _ in range(3):
+        admission = asyncio.run(fresh_db.admit_user(1, "user", "User"))
+        assert admission['is_banned'] is False
+
+    assert message_count(fresh_db, 1) == 3
+    assert fresh_db.conn.execute('SELECT total_messages FROM stats WHERE id = 1').fetchone()[0] == 3
+
+
+def test_day_rollover_counts_message_once_and_resets_quota(fresh_db, tb, monkeypatch):
+    day = {'value': '2026-01-01'}
+    monkeypatch.setattr(tb.Database, 'quota_day', staticmethod(lambda moment=None: day['value']))
+
+    asyncio.run(fresh_db.admit_user(1, "user", "User"))
+    fresh_db.increment_quota(1)
+    flush(fresh_db)
+    assert asyncio.run(fresh_db.admit_user(1, "user", "User"))['daily_used'] == 1
+
+    day['value'] = '2026-01-02'
+    admission = asyncio.run(fresh_db.admit_user(1, "user", "User"))
+
+    assert admission['quota_day'] == '2026-01-02'
+    assert admission['daily_used'] == 0
+    assert message_count(fresh_db, 1) == 3
+
+
+def test_ban_is_seen_by_next_admission(fresh_db):
+    asyncio.run(fresh_db.admit_user(1, "user", "User"))
+    asyncio.run(fresh_db.ban_user(1))
+
+    assert asyncio.run(fresh_db.admit_user(1, "user", "User"))['is_banned'] is True
+
+
+def test_admission_fails_closed_when_writer_times_out(fresh_db, monkeypatch):
+    async def timeout(*args, **kwargs):
+        raise asyncio.TimeoutError()
+
+    monkeypatch.setattr(fresh_db.writer, 'fetch_async', timeout)
+
+    assert asyncio.run(fresh_db.admit_user(1, "user", "User")) is None
@@ -0,0 +1,98 @@
+import asyncio
+from collections import Counter
+
+
+class FakeBot:
+    def __init__(self, tb, blocked=(), flood=None, delay=0.0):
+        self.tb = tb
+        self.blocked = set(blocked)
+        self.flood = Counter(flood or {})  # chat_id -> عدد RetryAfter قبل النجاح
+        self.delay = delay
+        self.sent = Counter()
+
+    async def send_message(self, chat_id, text):
+        await asyncio.sleep(self.delay)
+        if self.flood[chat_id] > 0:
+            self.flood[chat_id] -= 1
+            raise self.tb.RetryAfter(0)
+        if chat_id in self.blocked:
+            raise self.tb.Forbidden("bot was blocked by the user")
+        self.sent[chat_id] += 1
+
+    async def edit_message_text(self, *args, **kwargs):
+        pass
+
+
+def make_engine(tb):
+    engine = tb.BroadcastEngine(rate=1000, concurrency=5)
+    engine.PROGRESS_INTERVAL = 0.01
+    engine.bucket.pause = lambda seconds: None
+    return engine
+
+
+def flush(database):
+    database.writer.run(lambda cursor: None, wait=True)
+
+
+def test_resume_after_crash_sends_each_recipient_once(tb, fresh_db):
+    user_ids = list(range(1, 41))
+    bot = FakeBot(tb, blocked={5, 6}, delay=0.005)
+
+    async def scenario():
+        engine = make_engine(tb)
+        job = await engine.start(bot, "hello", user_ids, 1, 0, 0)
+        await asyncio.sleep(0.03)
+        # إعادة تشغيل مفاجئة: بدون checkpoint نهائي
+        job.task.cancel()
+        await asyncio.gather(job.task, return_exceptions=True)
+        flush(fresh_db)
+
+        resumed = make_engine(tb).resume(bot, job.job_id)
+        await resumed.task
+        flush(fresh_db)
+        return resumed
+
+    resumed = asyncio.run(scenario())
+
+    assert all(count == 1 for count in bot.sent.values())
+    assert set(bot.sent) == set(user_ids) - {5, 6}
+    assert (resumed.success, resumed.failed, resumed.blocked) == (38, 2, 2)
+    record = fresh_db.get_broadcast_job(resumed.job_id)
+    assert record['status'] == 'done'
+    assert (record['success'], record['failed'], record['blocked']) == (38, 2, 2)
+
+
+def test_flood_control_does_not_fail_recipient(tb, fresh_db):
+    bot = FakeBot(tb, flood={1: 5})
+
+    async def scenario():
+        job = await make_engine(tb).start(bot, "hello", [1, 2], 1, 0, 0)
+        await job.task
+        flush(fresh_db)
+        return job
+
+    job = asyncio.run(scenario())
+
+    assert bot.sent == Counter({1: 1, 2: 1})
+    assert job.rate_limited == 5
+    assert fresh_db.get_broadcast_outcomes(job.job_id) == {'sent': 2}
+
+
+def test_resume_refused_while_another_broadcast_runs(tb, fresh_db):
+    bot = FakeBot(tb, delay=0.01)
+
+    async def scenario():
+        engine = make_engine(tb)
+        paused = await engine.start(bot, "first", [1, 2, 3], 1, 0, 0)
+        engine.pause(paused.job_id)
+        await paused.task
+        running = await engine.start(bot, "second", list(range(10, 30)), 1, 0, 0)
+        refused = engine.resume(bot, paused.job_id)
+        current = engine.current
+        await running.task
+        return refused, current, running
+
+    refused, current, running = asyncio.run(scenario())
+
+    assert refused is None
+    assert current is running
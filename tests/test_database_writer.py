@@ -0,0 +1,48 @@
+import asyncio
+import time
+
+import pytest
+
+
+def test_run_async_returns_result_without_blocking_loop(fresh_db):
+    async def scenario():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        result = await fresh_db.writer.run_async(lambda cursor: (time.sleep(0.2), 42)[1])
+        task.cancel()
+        return result, ticks
+
+    result, ticks = asyncio.run(scenario())
+    assert result == 42
+    assert ticks >= 5
+
+
+def test_run_async_propagates_errors_and_timeouts(fresh_db):
+    async def failing():
+        await fresh_db.writer.run_async(lambda cursor: cursor.execute('SELECT * FROM missing_table'))
+
+    async def slow():
+        await fresh_db.writer.run_async(lambda cursor: time.sleep(0.3), timeout=0.05)
+
+    with pytest.raises(Exception, match="missing_table"):
+        asyncio.run(failing())
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(slow())
+
+
+def test_purge_expired_translations(fresh_db):
+    fresh_db.save_translation("old", "src", "dst")
+    fresh_db.writer.execute('UPDATE translation_cache SET created_at = 0', wait=True)
+    fresh_db.save_translation("new", "src", "dst")
+
+    removed = asyncio.run(fresh_db.purge_expired_translations(3600))
+
+    assert removed == 1
+    assert fresh_db.get_cached_translation("new", 3600) == "dst"
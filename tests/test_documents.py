@@ -0,0 +1,165 @@
+import asyncio
+from concurrent.futures import Future
+
+import PyPDF2
+import pytest
+
+
+class FakePool:
+    """مجمع متزامن: ينفذ المهام فوراً، ويفشل في النطاق المحدد"""
+
+    def __init__(self, tb, page_count=4, failing_start=None, broken=False):
+        self.tb = tb
+        self.page_count = page_count
+        self.failing_start = failing_start
+        self.broken = broken
+        self.shut_down = False
+
+    def submit(self, fn, *args):
+        if self.broken:
+            raise self.tb.BrokenProcessPool("worker died")
+        future = Future()
+        if fn is self.tb.pdf_worker.page_count:
+            future.set_result(self.page_count)
+        elif args[1] == self.failing_start:
+            future.set_exception(ValueError(f"bad page range {args[1]}-{args[2]}"))
+        else:
+            future.set_result([f"page {i + 1}" for i in range(args[1], args[2])])
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.shut_down = True
+
+
+def collect(tb, path, pages):
+    async def scenario():
+        async for number, total, text in tb.FileProcessor.iter_pdf_pages(path):
+            pages.append((number, total, text))
+
+    asyncio.run(scenario())
+
+
+def write_pdf(path, pages):
+    writer = PyPDF2.PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=200, height=200)
+    with open(path, 'wb') as f:
+        writer.write(f)
+
+
+@pytest.fixture
+def pdf_settings(tb, monkeypatch):
+    monkeypatch.setattr(tb, 'PDF_WORKERS', 1)
+    monkeypatch.setattr(tb, 'PDF_PAGES_PER_TASK', 2)
+
+
+def test_pdf_pages_are_extracted_in_worker_processes(tb, tmp_path, pdf_settings):
+    path = str(tmp_path / "doc.pdf")
+    write_pdf(path, 3)
+    pages = []
+
+    try:
+        collect(tb, path, pages)
+    finally:
+        tb.shutdown_pdf_pool()
+
+    assert [(number, total) for number, total, _ in pages] == [(1, 3), (2, 3), (3, 3)]
+
+
+def test_unreadable_pdf_raises(tb, tmp_path, pdf_settings):
+    path = tmp_path / "broken.pdf"
+    path.write_bytes(b"%PDF-1.4 not really a pdf")
+
+    try:
+        with pytest.raises(Exception):
+            collect(tb, str(path), [])
+    finally:
+        tb.shutdown_pdf_pool()
+
+
+def test_failing_page_range_raises_after_earlier_pages(tb, monkeypatch, pdf_settings):
+    monkeypatch.setattr(tb, '_pdf_pool', FakePool(tb, page_count=4, failing_start=2))
+    pages = []
+
+    with pytest.raises(ValueError, match="bad page range 2-4"):
+        collect(tb, "doc.pdf", pages)
+
+    assert [text for _, _, text in pages] == ["page 1", "page 2"]
+
+
+def test_broken_pool_is_discarded_and_error_raised(tb, monkeypatch, pdf_settings):
+    pool = FakePool(tb, broken=True)
+    monkeypatch.setattr(tb, '_pdf_pool', pool)
+
+    with pytest.raises(tb.BrokenProcessPool):
+        collect(tb, "doc.pdf", [])
+
+    assert pool.shut_down
+    assert tb._pdf_pool is None
+
+
+class FakeMessage:
+    def __init__(self, document=None):
+        self.document = document
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+        return FakeMessage()
+
+    async def edit_text(self, text, **kwargs):
+        pass
+
+    async def delete(self):
+        pass
+
+
+class FakeFile:
+    async def download_to_drive(self, custom_path):
+        with open(custom_path, 'wb') as f:
+            f.write(b"%PDF-1.4 uploaded")
+
+
+class FakeBot:
+    async def get_file(self, file_id):
+        return FakeFile()
+
+
+def upload(tb, monkeypatch, pool):
+    monkeypatch.setattr(tb, '_pdf_pool', pool)
+    monkeypatch.setattr(tb, 'check_rate_limit', lambda user_id, feature: (True, 0))
+    document = type("Document", (), {
+        "file_name": "notes.pdf", "file_size": 1024, "file_id": "file-id", "file_unique_id": "unique-id",
+    })()
+    message = FakeMessage(document)
+    update = type("Update", (), {"message": message, "effective_user": type("User", (), {"id": 1})()})()
+    context = type("Context", (), {"user_data": {}, "bot": FakeBot()})()
+    asyncio.run(tb.handle_document(update, context))
+    return message, context
+
+
+def stored_rows(database):
+    database.writer.run(lambda cursor: None, wait=True)
+    return [database.conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+            for table in ('documents', 'document_files')]
+
+
+def test_failed_extraction_stores_nothing(tb, fresh_db, monkeypatch, pdf_settings):
+    monkeypatch.setattr(tb.document_store, 'memory', tb.OrderedDict())
+
+    message, context = upload(tb, monkeypatch, FakePool(tb, page_count=4, failing_start=2))
+
+    assert stored_rows(fresh_db) == [0, 0]
+    assert len(tb.document_store.memory) == 0
+    assert 'document_ref' not in context.user_data
+    assert "bad page range" in message.replies[-1]
+
+
+def test_complete_extraction_is_stored(tb, fresh_db, monkeypatch, pdf_settings):
+    monkeypatch.setattr(tb.document_store, 'memory', tb.OrderedDict())
+
+    message, context = upload(tb, monkeypatch, FakePool(tb, page_count=4))
+
+    assert stored_rows(fresh_db) == [1, 1]
+    stored = tb.document_store.get(context.user_data['document_ref'])
+    assert stored.text == "page 1\npage 2\npage 3\npage 4"
@@ -0,0 +1,163 @@
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+BASELINE_SCHEMA = '''
+    CREATE TABLE users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        is_banned INTEGER DEFAULT 0,
+        is_muted INTEGER DEFAULT 0,
+        message_count INTEGER DEFAULT 0,
+        joined_at TEXT,
+        last_activity TEXT,
+        subscription_tier TEXT DEFAULT 'free',
+        daily_quota_used INTEGER DEFAULT 0,
+        daily_video_quota INTEGER DEFAULT 0,
+        last_quota_reset TEXT,
+        preferred_language TEXT DEFAULT 'ar',
+        last_message_time REAL DEFAULT 0
+    );
+    CREATE TABLE stats (
+        id INTEGER PRIMARY KEY,
+        total_messages INTEGER DEFAULT 0,
+        total_users INTEGER DEFAULT 0,
+        last_updated TEXT
+    );
+    CREATE TABLE conversations (
+        user_id INTEGER,
+        chat_id INTEGER,
+        message TEXT,
+        response TEXT,
+        timestamp TEXT
+    );
+    INSERT INTO stats (id, total_messages, total_users) VALUES (1, 0, 0);
+'''
+
+
+@pytest.fixture
+def open_database(tb):
+    opened = []
+
+    def open_at(path):
+        database = tb.Database(use_database=True, path=str(path))
+        opened.append(database)
+        return database
+
+    yield open_at
+    for database in opened:
+        database.writer.close()
+
+
+def make_baseline(path, users, conversations=()):
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.executemany('''
+        INSERT INTO users (user_id, username, is_banned, is_muted, message_count,
+                           daily_quota_used, daily_video_quota, last_quota_reset)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', users)
+    conn.executemany('INSERT INTO conversations VALUES (?, ?, ?, ?, ?)', conversations)
+    conn.commit()
+    conn.close()
+
+
+def test_fresh_database_is_at_current_version(tmp_path, open_database, tb):
+    database = open_database(tmp_path / "bot.db")
+
+    version = database.conn.execute('PRAGMA user_version').fetchone()[0]
+    assert version == tb.Database.SCHEMA_VERSION
+
+
+def test_v1_keeps_last_conversation_messages(tmp_path, open_database, tb):
+    path = tmp_path / "bot.db"
+    limit = tb.Database.CONVERSATION_HISTORY_LIMIT
+    make_baseline(path, [], [(1, 1, f"m{i}", f"r{i}", f"t{i}") for i in range(limit + 5)])
+
+    database = open_database(path)
+
+    messages = [row[0] for row in database.conn.execute('SELECT message FROM conversations ORDER BY rowid')]
+    assert messages == [f"m{i}" for i in range(5, limit + 5)]
+
+
+def test_v2_moves_todays_usage_including_users_never_reset(tmp_path, open_database, tb):
+    path = tmp_path / "bot.db"
+    make_baseline(path, [
+        (1, "never_reset", 0, 0, 1, 2, 1, None),
+        (2, "reset_today", 0, 0, 1, 3, 0, datetime.now().isoformat()),
+        (3, "stale", 0, 0, 1, 4, 0, "2020-01-01T00:00:00"),
+    ])
+
+    database = open_database(path)
+
+    assert database.get_user_quota(1) == {'tier': 'free', 'daily_used': 2, 'daily_video_used': 1}
+    assert database.get_user_quota(2)['daily_used'] == 3
+    assert database.get_user_quota(3)['daily_used'] == 0
+
+
+def test_v3_rebuilds_stats_counters(tmp_path, open_database):
+    path = tmp_path / "bot.db"
+    make_baseline(path, [
+        (1, "a", 1, 0, 5, 0, 0, None),
+        (2, "b", 0, 1, 7, 0, 0, None),
+        (3, "c", 0, 0, 0, 0, 0, None),
+    ])
+
+    database = open_database(path)
+
+    assert database.get_stats() == {'total_users': 3, 'banned_users': 1, 'muted_users': 1, 'total_messages': 12}
+
+
+def test_v4_adds_blocked_flag(tmp_path, open_database):
+    path = tmp_path / "bot.db"
+    make_baseline(path, [(1, "a", 0, 0, 1, 0, 0, None)])
+
+    database = open_database(path)
+
+    assert database.get_all_user_ids() == [1]
+    database.mark_user_blocked(1)
+    database.writer.run(lambda cursor: None, wait=True)
+    assert database.get_all_user_ids() == []
+
+
+def test_v5_marks_recipients_before_cursor_of_unfinished_jobs(tmp_path, open_database):
+    path = tmp_path / "bot.db"
+    make_baseline(path, [])
+    conn = sqlite3.connect(path)
+    conn.executescript('''
+        CREATE TABLE broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, text TEXT, status TEXT DEFAULT 'running',
+            created_by INTEGER, created_at TEXT, updated_at TEXT, total INTEGER DEFAULT 0,
+            cursor INTEGER DEFAULT 0, success INTEGER DEFAULT 0, failed INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0, status_chat_id INTEGER, status_message_id INTEGER
+        );
+        CREATE TABLE broadcast_recipients (
+            job_id INTEGER, position INTEGER, user_id INTEGER, PRIMARY KEY (job_id, position)
+        ) WITHOUT ROWID;
+        INSERT INTO broadcast_jobs (id, text, status, total, cursor) VALUES (1, 'hi', 'paused', 4, 2);
+        INSERT INTO broadcast_jobs (id, text, status, total, cursor) VALUES (2, 'done', 'done', 2, 2);
+        INSERT INTO broadcast_recipients VALUES (1, 0, 10), (1, 1, 11), (1, 2, 12), (1, 3, 13);
+        INSERT INTO broadcast_recipients VALUES (2, 0, 20), (2, 1, 21);
+        PRAGMA user_version = 4;
+    ''')
+    conn.commit()
+    conn.close()
+
+    database = open_database(path)
+
+    assert database.get_broadcast_recipients(1, 2) == [(2, 12), (3, 13)]
+    assert database.get_broadcast_outcomes(1) == {'sent': 2}
+    assert database.get_broadcast_outcomes(2) == {}
+
+
+def test_migration_runs_once(tmp_path, open_database, tb):
+    path = tmp_path / "bot.db"
+    make_baseline(path, [(1, "a", 0, 0, 1, 2, 0, None)])
+    open_database(path).writer.close()
+
+    database = open_database(path)
+
+    assert database.get_user_quota(1)['daily_used'] == 2
+    assert database.conn.execute('PRAGMA user_version').fetchone()[0] == tb.Database.SCHEMA_VERSION
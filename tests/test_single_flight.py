@@ -0,0 +1,88 @@
+import asyncio
+
+
+def test_identical_requests_share_one_call(tb):
+    async def scenario():
+        flight = tb.SingleFlight()
+        calls = 0
+
+        async def fetch():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return "result"
+
+        key = flight.key("search", "  Hello World ")
+        results = await asyncio.gather(flight.do(key, fetch), flight.do(key, fetch))
+        return calls, results, flight.in_flight
+
+    calls, results, in_flight = asyncio.run(scenario())
+    assert calls == 1
+    assert results == ["result", "result"]
+    assert in_flight == {}
+
+
+def test_one_waiter_leaving_does_not_cancel_shared_call(tb):
+    async def scenario():
+        flight = tb.SingleFlight()
+
+        async def fetch():
+            await asyncio.sleep(0.05)
+            return "result"
+
+        key = flight.key("search", "q")
+        first = asyncio.create_task(flight.do(key, fetch))
+        second = asyncio.create_task(flight.do(key, fetch))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(scenario()) == "result"
+
+
+def test_last_waiter_leaving_cancels_shared_call(tb):
+    async def scenario():
+        flight = tb.SingleFlight()
+        cancelled = asyncio.Event()
+
+        async def fetch():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        key = flight.key("nano_banana", "q")
+        waiter = asyncio.create_task(flight.do(key, fetch))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        return flight.in_flight, flight.waiters
+
+    in_flight, waiters = asyncio.run(scenario())
+    assert in_flight == {}
+    assert waiters == {}
+
+
+def test_new_caller_after_last_waiter_cancels_gets_fresh_call(tb):
+    async def scenario():
+        flight = tb.SingleFlight()
+        calls = 0
+
+        async def fetch():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.05 if calls == 1 else 0)
+            return f"call {calls}"
+
+        key = flight.key("search", "q")
+        waiter = asyncio.create_task(flight.do(key, fetch))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        # المهمة الملغاة لم تنتهِ بعد، والمنتظر الجديد يجب ألا ينضم إليها
+        return await flight.do(key, fetch), calls
+
+    result, calls = asyncio.run(scenario())
+    assert result == "call 2"
+    assert calls == 2